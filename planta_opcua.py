@@ -7,116 +7,319 @@ exposing OPC UA variables (e.g., DB1.MV, DB1.PV).
 
 import time
 from opcua import Client, ua
+from opcua.ua.uaerrors import BadTimeout
+from concurrent.futures import TimeoutError as FutureTimeout
 import sys
-import random
+import os
+import threading
+import queue
+import errno
+import ctypes
+import ctypes.util
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional: fall back to plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # === CONFIGURATION ===
 OPC_ENDPOINT = "opc.tcp://192.168.0.1:4840"  # OPC UA endpoint
 NODE_MV = 'ns=3;s="PID_SIM_3_DB"."ManipulatedValue"'  # NodeId for MV
 NODE_PV = 'ns=3;s="PID_SIM_3_DB"."ProcessValue"'      # NodeId for PV
 TS = 0.1          # sampling time [s] (must match OB in PLC)
+TS_NS = int(TS * 1e9 + 0.5)  # sampling time [ns] for absolute deadlines
 Kproc = 1.0       # plant gain
 Tau = 2.0         # plant time constant [s]
 NOISE_PCT = 0.0025  # ±0.25% multiplicative noise
+NOISE_BLOCK = 10000  # noise samples generated per RNG call
+
+LOG_PERIOD = 1.0  # console log period [s]
+LOG_EVERY = max(1, int(LOG_PERIOD / TS + 0.5))  # cycles between log lines
+
+# Discrete plant coefficients: pv[k+1] = A*pv[k] + B*mv[k] (explicit Euler)
+A = 1.0 - TS / Tau
+B = TS * Kproc / Tau
+NOISE_SCALE = 2.0 * NOISE_PCT
 
 # === DELAY SETTINGS ===
 DELAY_SEC = 10.0
-DELAY_SAMPLES = int(DELAY_SEC / TS + 0.5)
+DELAY_SAMPLES = int(DELAY_SEC / TS + 0.5)  # 0 runs the plant without dead time
 
-# Initialize plant state and FIFO for delayed MV
-pv = 20.0
-t = 0.0
+# Initial plant state
+initial_pv = 20.0
 initial_mv = 0.0
-fifo = [initial_mv] * DELAY_SAMPLES
+
+# State shared with the OPC UA I/O thread
+latest_mv = initial_mv  # updated by the MV subscription
+pv_datavalue = ua.DataValue(ua.Variant(initial_pv, ua.VariantType.Float))  # reused for every PV write
+
+# Errors worth one retry on the same session before reconnecting.
+# python-opcua raises client-side timeouts from future.result(); before
+# Python 3.11 that FutureTimeout is not the builtin TimeoutError.
+TRANSIENT_ERRORS = (BadTimeout, FutureTimeout, TimeoutError)
+
+# OPC UA I/O runs in its own thread; the loop only hands PVs over this queue.
+# It holds just the latest PV: the PLC never needs an older one.
+pv_q = queue.Queue(maxsize=1)
+connected = threading.Event()
+stop = threading.Event()
+
+# === LOOP TIMING ===
+# clock_nanosleep() is not exposed by the time module, so it is called from
+# libc where available (Linux). Constants are the Linux values.
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+SPIN_NS = 200_000   # busy-wait the last 200 us before each deadline
+RT_PRIORITY = 50    # SCHED_FIFO priority for the simulation loop
+RT_CPU = 3          # CPU to pin the loop to (isolate it with isolcpus=3), None to disable
+
+class Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except (OSError, TypeError):
+    _libc = None
+_clock_nanosleep = getattr(_libc, "clock_nanosleep", None)
+_mlockall = getattr(_libc, "mlockall", None)
 
 # --- HELPER FUNCTIONS ---
 
+def sleep_until(deadline_ns):
+    """Sleep until an absolute monotonic deadline [ns], spinning the last SPIN_NS."""
+    wake_ns = deadline_ns - SPIN_NS
+    if _clock_nanosleep is not None:
+        ts = Timespec(wake_ns // 1_000_000_000, wake_ns % 1_000_000_000)
+        while _clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(ts), None) == errno.EINTR:
+            pass
+    else:
+        remaining = wake_ns - time.monotonic_ns()
+        if remaining > 0:
+            time.sleep(remaining / 1e9)
+    while time.monotonic_ns() < deadline_ns:
+        pass
+
+def setup_realtime():
+    """Pin the loop to RT_CPU under SCHED_FIFO with locked memory (best effort, Linux)."""
+    if RT_CPU is not None:
+        try:
+            os.sched_setaffinity(0, {RT_CPU})
+            print(f"[OK] Pinned to CPU {RT_CPU}")
+        except (AttributeError, OSError) as e:
+            print(f"[WARN] Could not pin to CPU {RT_CPU}: {e}")
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+        print(f"[OK] SCHED_FIFO priority {RT_PRIORITY}")
+    except (AttributeError, OSError) as e:
+        print(f"[WARN] Real-time scheduling not available: {e}")
+    if _mlockall is not None:
+        if _mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+            print("[OK] Memory locked")
+        else:
+            print(f"[WARN] mlockall failed: {os.strerror(ctypes.get_errno())}")
+
+@njit(cache=True)
+def plant_step(pv, mv_delayed, noise_u):
+    """One TS step of the first-order plant with noise and 0..100 saturation."""
+    # First-order plant model (explicit Euler)
+    new_pv = A * pv + B * mv_delayed
+    # Apply multiplicative noise (noise_u uniform in [0, 1))
+    new_pv *= 1.0 + (noise_u - 0.5) * NOISE_SCALE
+    # Saturate PV to 0..100 (written so a NaN is clamped too, no builtin calls)
+    if not new_pv >= 0.0:
+        new_pv = 0.0
+    elif new_pv > 100.0:
+        new_pv = 100.0
+    return new_pv
+
+class SubHandler:
+    """Keep the latest MV pushed by the OPC UA subscription."""
+
+    def datachange_notification(self, node, val, data):
+        global latest_mv
+        if val is not None:  # skip notifications with a bad status
+            latest_mv = val  # Float on the wire, already unpacked to a Python float
+
+def register_nodes(client, nodes):
+    """Swap the string NodeIds for the server's registered aliases, if supported."""
+    try:
+        client.register_nodes(nodes)
+    except Exception as e:
+        print(f"[WARN] RegisterNodes not supported, using string NodeIds: {e}")
+
 def connect_client():
-    """Connect to OPC UA server with retry loop."""
+    """Connect to OPC UA server and subscribe to MV, with retry loop."""
+    global latest_mv
     while True:
         try:
             client = Client(OPC_ENDPOINT)
             client.connect()
+            node_mv, node_pv = client.get_node(NODE_MV), client.get_node(NODE_PV)
+            register_nodes(client, [node_mv, node_pv])
+            latest_mv = float(node_mv.get_value())
+            sub = client.create_subscription(TS * 1000, SubHandler())
+            sub.subscribe_data_change(node_mv)
             print(f"[OK] Connected to {OPC_ENDPOINT}")
-            return client, client.get_node(NODE_MV), client.get_node(NODE_PV)
+            return client, node_mv, node_pv
         except Exception as e:
             print(f"[WARN] Connection failed: {e}. Retrying in 3s...")
+            try:
+                client.disconnect()  # do not leave a half-set-up session on the server
+            except Exception:
+                pass
             time.sleep(3)
 
-def write_value(node, value):
-    """Write float value to OPC UA node."""
+def check_config():
+    """Exit with a message if the configuration cannot be simulated."""
+    errors = []
+    if TS <= 0.0:
+        errors.append(f"TS must be > 0 (got {TS})")
+    if DELAY_SEC < 0.0:
+        errors.append(f"DELAY_SEC must be >= 0 (got {DELAY_SEC})")
+    if errors:
+        for err in errors:
+            print(f"[ERROR] Invalid configuration: {err}")
+        sys.exit(1)
+
+def make_pv_write(node_pv):
+    """Build the WriteParameters reused for every PV write."""
+    wv = ua.WriteValue()
+    wv.NodeId = node_pv.nodeid
+    wv.AttributeId = ua.AttributeIds.Value
+    wv.Value = pv_datavalue
+    params = ua.WriteParameters()
+    params.NodesToWrite = [wv]
+    return params
+
+def write_value(client, pv_write, value):
+    """Write PV as Float in one OPC UA request using prebuilt WriteParameters.
+
+    Returns True on success, None on a transient error and False if the
+    session is lost. A link that dies without a TCP reset first shows up as
+    a client-side TimeoutError, so with the retry it takes 2 x client.timeout
+    (8 s with the default 4 s) before the worker reconnects.
+    """
     try:
-        node.set_attribute(ua.AttributeIds.Value, ua.DataValue(ua.Variant(value, ua.VariantType.Float)))
+        pv_datavalue.Value.Value = value
+        client.uaclient.write(pv_write)[0].check()
         return True
+    except TRANSIENT_ERRORS as e:
+        print(f"Warning: PV write timed out: {e!r}")
+        return None
     except Exception as e:
         print(f"Error writing PV: {e}")
         return False
 
-def read_value(node):
-    """Read float value from OPC UA node."""
+def opcua_worker():
+    """Own the OPC UA session: connect, subscribe to MV and write queued PVs."""
+    client, node_mv, node_pv = connect_client()
+    pv_write = make_pv_write(node_pv)
+    connected.set()
     try:
-        return float(node.get_value())
-    except Exception as e:
-        print(f"Error reading MV: {e}")
-        return None
+        while not stop.is_set():
+            try:
+                value = pv_q.get(timeout=TS)
+            except queue.Empty:
+                continue
+            ok = write_value(client, pv_write, value)
+            if ok is None:  # transient: retry once before tearing the session down
+                ok = write_value(client, pv_write, value)
+            if not ok:
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+                print("[INFO] Reconnecting...")
+                client, node_mv, node_pv = connect_client()
+                pv_write = make_pv_write(node_pv)
+    finally:
+        try:
+            client.disconnect()
+            print("[OK] Disconnected correctly.")
+        except:
+            pass
 
 # --- MAIN LOOP ---
 
-client, node_mv, node_pv = connect_client()
+def main():
+    """Start the OPC UA I/O thread and run the plant loop until Ctrl+C."""
+    check_config()
 
-try:
-    while True:
-        start = time.time()
+    # Plant state and ring buffer for delayed MV
+    pv = initial_pv
+    t = 0.0
+    k = 0  # cycle counter
+    fifo = np.full(max(DELAY_SAMPLES, 1), initial_mv, dtype=np.float32)
+    widx = 0  # write pointer, always at the oldest sample
+    rng = np.random.default_rng()
+    noise_buf = rng.random(NOISE_BLOCK).tolist()  # pregenerated uniform [0, 1) samples
+    ni = 0  # next unused noise sample
 
-        # Read MV from PLC
-        mv = read_value(node_mv)
-        if mv is None:
-            client.disconnect()
-            print("[INFO] Reconnecting...")
-            client, node_mv, node_pv = connect_client()
-            continue
+    io_thread = threading.Thread(target=opcua_worker, name="opcua-io", daemon=True)
+    io_thread.start()
+    connected.wait()
+    plant_step(pv, initial_mv, 0.5)  # trigger JIT compilation before going real-time
+    setup_realtime()  # after starting the I/O thread so it keeps normal priority
+    deadline = time.monotonic_ns()
 
-        # Apply FIFO delay
-        fifo.append(mv)
-        mv_delayed = fifo.pop(0)
+    try:
+        while True:
+            start = time.monotonic_ns()
 
-        # First-order plant model (explicit Euler)
-        new_pv = pv + TS * ((Kproc * mv_delayed - pv) / Tau)
+            # Latest MV pushed by the PLC subscription
+            mv = latest_mv
 
-        # Apply multiplicative noise
-        noise = (random.random() - 0.5) * 2.0 * NOISE_PCT
-        new_pv *= (1.0 + noise)
+            # Apply FIFO delay (overwrite oldest sample, advance pointer)
+            if DELAY_SAMPLES:
+                mv_delayed = fifo.item(widx)
+                fifo[widx] = mv
+                widx = (widx + 1) % DELAY_SAMPLES
+            else:
+                mv_delayed = mv  # no dead time
 
-        # Saturate PV to 0..100
-        new_pv = max(0.0, min(100.0, new_pv))
-        pv = new_pv
+            # Plant model, noise and saturation
+            if ni >= NOISE_BLOCK:
+                noise_buf = rng.random(NOISE_BLOCK).tolist()
+                ni = 0
+            pv = plant_step(pv, mv_delayed, noise_buf[ni])
+            ni += 1
 
-        # Write PV back to PLC
-        if not write_value(node_pv, pv):
-            client.disconnect()
-            print("[INFO] Reconnecting...")
-            client, node_mv, node_pv = connect_client()
-            continue
-
-        # Simple logging
-        print(f"t={t:.2f}s  MV={mv:.2f}  MV_delayed={mv_delayed:.2f}  PV={pv:.3f}")
-
-        # Synchronize loop with TS
-        elapsed = time.time() - start
-        sleep_for = TS - elapsed
-        if sleep_for > 0:
-            time.sleep(sleep_for)
-        else:
-            print(f"Warning: loop took {elapsed:.3f}s > TS={TS}s")
-        t += TS
+            # Hand PV to the I/O thread, replacing one it has not taken yet
+            try:
+                pv_q.put_nowait(pv)
+            except queue.Full:
+                try:
+                    pv_q.get_nowait()
+                except queue.Empty:
+                    pass
+                pv_q.put_nowait(pv)  # only this thread puts, so there is room now
 
-except KeyboardInterrupt:
-    print("\n[SIGINT] Cancelled by user.")
-finally:
-    try:
-        client.disconnect()
-        print("[OK] Disconnected correctly.")
-    except:
-        pass
+            # Simple logging, throttled to one line per LOG_PERIOD
+            if k % LOG_EVERY == 0:
+                print(f"t={t:.2f}s  MV={mv:.2f}  MV_delayed={mv_delayed:.2f}  PV={pv:.3f}")
+
+            # Synchronize loop with TS on absolute deadlines (no drift)
+            deadline += TS_NS
+            now = time.monotonic_ns()
+            if now < deadline:
+                sleep_until(deadline)
+            else:
+                print(f"Warning: loop took {(now - start) / 1e9:.3f}s > TS={TS}s")
+                deadline = now  # resync instead of bursting to catch up
+            t += TS
+            k += 1
+
+    except KeyboardInterrupt:
+        print("\n[SIGINT] Cancelled by user.")
+    finally:
+        stop.set()
+        io_thread.join(timeout=5)
+
+        sys.exit(0)
 
-    sys.exit(0)
+if __name__ == "__main__":
+    main()